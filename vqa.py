@@ -1,9 +1,10 @@
 import os
 import base64  # Importing base64 for image encoding
 from google.oauth2 import service_account
+import google.auth.transport.requests
 import streamlit as st
 from google.cloud import storage
-from datetime import timedelta
+from datetime import datetime, timedelta, timezone
 import vertexai
 from vertexai.generative_models import (
     Part,
@@ -11,7 +12,81 @@ from vertexai.generative_models import (
     SafetySetting
 )
 from google.cloud.exceptions import NotFound
-import time  # Import time for unique file names
+from google.api_core import exceptions as api_exceptions
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
+import itertools
+import time
+import json
+import uuid
+import threading
+import hashlib
+import io
+import shutil
+import subprocess
+import tempfile
+import redis
+import queue
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from vertexai.batch_prediction import BatchPredictionJob
+from vertexai.preview import caching
+from vertexai.preview.generative_models import GenerativeModel as PreviewGenerativeModel
+
+BUCKET_NAME = "air-refueling-video-analysis-bucket"  # Make sure this is the correct bucket name
+
+# Uploaded videos are kept under their own prefix, apart from batch job files
+VIDEO_PREFIX = "videos/"
+
+# Display names for the Gemini model versions offered in the UI
+MODEL_VERSIONS = {
+    "Light": "gemini-1.5-flash-001",
+    "Pro": "gemini-1.5-pro-001"
+}
+
+# Generation and safety settings are the same for every analysis, so build them once
+GENERATION_CONFIG = {
+    "max_output_tokens": 8192,
+    "temperature": 0,
+    "top_p": 0.95,
+    "response_mime_type": "text/plain",
+}
+
+SAFETY_SETTINGS = [
+    SafetySetting(
+        category=category,
+        threshold=SafetySetting.HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE
+    )
+    for category in (
+        SafetySetting.HarmCategory.HARM_CATEGORY_HATE_SPEECH,
+        SafetySetting.HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT,
+        SafetySetting.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT,
+        SafetySetting.HarmCategory.HARM_CATEGORY_HARASSMENT,
+    )
+]
+
+# Length in seconds of the windows signed URL expirations are aligned to
+SIGNED_URL_INTERVAL = 900
+
+# Analysis results are deterministic at temperature 0, so they can be reused for a day
+ANALYSIS_CACHE_TTL = 24 * 60 * 60
+
+# How long Vertex AI keeps a video's context cache; the app stops using it 5 minutes earlier
+CONTEXT_CACHE_TTL = timedelta(minutes=30)
+
+# Resumable upload chunk size; GCS requires a multiple of 256 KiB
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+
+# Seconds to wait for the faststart remux before uploading the original video instead
+FFMPEG_TIMEOUT = 120
+
+# Seconds between status checks while a batch prediction job is running
+BATCH_POLL_INTERVAL = 15
+
+# Approximate progress shown for each batch prediction job state
+BATCH_JOB_PROGRESS = {
+    "JOB_STATE_QUEUED": 0.1,
+    "JOB_STATE_PENDING": 0.2,
+    "JOB_STATE_RUNNING": 0.5,
+}
 
 # Load custom CSS for adding a background image and styling text and buttons
 def set_bg_hack(main_bg):
@@ -28,6 +103,7 @@ def set_bg_hack(main_bg):
             background-attachment: fixed;
         }}
         h1 {{
+            text-align: center;
             color: darkblue;
             font-size: 40px;  /* Increased font size by 2 units */
             font-weight: bold;  /* Make text bold */
@@ -62,44 +138,236 @@ def set_bg_hack(main_bg):
         unsafe_allow_html=True
     )
 
+@st.cache_data(show_spinner=False)
+def load_background_image(path, modified_time):
+    """
+    Read the background image from disk and encode it to base64, once rather than on every rerun.
+    modified_time is only part of the cache key, so replacing the file busts the cache.
+    """
+    with open(path, "rb") as image_file:
+        return base64.b64encode(image_file.read()).decode()
+
+@st.cache_resource
 def get_google_credentials():
     google_credentials = st.secrets["google_credentials"]
-    return service_account.Credentials.from_service_account_info(google_credentials)
+    credentials = service_account.Credentials.from_service_account_info(
+        google_credentials, scopes=["https://www.googleapis.com/auth/cloud-platform"]
+    )
+    # Fetch the access token up front so the first API call doesn't pay for it
+    credentials.refresh(google.auth.transport.requests.Request())
+    return credentials
 
 # Google Cloud Client with the credentials from Secrets
 credentials = get_google_credentials()
-storage_client = storage.Client(credentials=credentials)
 vertexai.init(project="genai-project-434704", location="us-central1", credentials=credentials)
 
+@st.cache_resource
+def get_storage_client():
+    """
+    Create a single Google Cloud Storage client shared across reruns and sessions
+    """
+    return storage.Client(credentials=credentials)
+
+@st.cache_resource
+def get_redis_client():
+    """
+    Connect to the Redis cache shared by all app workers, or return None if none is configured
+    """
+    if "redis_url" not in st.secrets:
+        return None
+    return redis.Redis.from_url(
+        st.secrets["redis_url"], decode_responses=True, socket_connect_timeout=2, socket_timeout=2
+    )
+
+def get_shared_cache(key):
+    """
+    Read a value from the shared Redis cache; a missing or unreachable cache counts as a miss
+    """
+    redis_client = get_redis_client()
+    if redis_client is None:
+        return None
+    try:
+        return redis_client.get(key)
+    except redis.RedisError:
+        return None
+
+def get_shared_cache_with_ttl(key):
+    """
+    Read a value and its remaining lifetime in seconds from the shared Redis cache, or (None, None) on a miss
+    """
+    redis_client = get_redis_client()
+    if redis_client is None:
+        return None, None
+    try:
+        value, ttl = redis_client.pipeline().get(key).ttl(key).execute()
+    except redis.RedisError:
+        return None, None
+    if value is None:
+        return None, None
+    # A negative TTL means the key has no expiry (or just expired)
+    return value, ttl if ttl > 0 else None
+
+def set_shared_cache(key, value, ttl):
+    """
+    Store a value in the shared Redis cache for ttl seconds, ignoring cache failures
+    """
+    redis_client = get_redis_client()
+    if redis_client is None:
+        return
+    try:
+        redis_client.set(key, value, ex=ttl)
+    except redis.RedisError:
+        pass
+
+@st.cache_data(ttl=60, show_spinner=False)
 def list_videos(bucket_name):
     """
     Function to list videos from Google Cloud Storage
     """
-    bucket = storage_client.bucket(bucket_name)
-    blobs = bucket.list_blobs()
-    return [blob.name for blob in blobs if blob.name.endswith('.mp4')]
+    # Filter on the server and only ask for object names to keep the listing small
+    blobs = get_storage_client().list_blobs(
+        bucket_name, match_glob="**.mp4", fields="items(name),nextPageToken"
+    )
+    return [blob.name for blob in blobs]
 
+# Signed URL expirations are pinned to interval boundaries, so every call within
+# the same interval returns a byte-identical URL the browser can cache
+@st.cache_data(ttl=SIGNED_URL_INTERVAL, show_spinner=False)
 def generate_signed_url(bucket_name, blob_name):
     """
     Generate a signed URL for accessing the video file
     """
-    bucket = storage_client.bucket(bucket_name)
+    cache_key = f"signed_url:{bucket_name}:{blob_name}"
+    url = get_shared_cache(cache_key)
+    if url is not None:
+        return url
+
+    bucket = get_storage_client().bucket(bucket_name)
     blob = bucket.blob(blob_name)
 
-    url = blob.generate_signed_url(expiration=timedelta(minutes=30)) 
+    # Valid for 30 to 45 minutes, so a cached URL always has at least 15 minutes left
+    now = int(time.time())
+    interval_start = now // SIGNED_URL_INTERVAL * SIGNED_URL_INTERVAL
+    expires_at = datetime.fromtimestamp(interval_start + 3 * SIGNED_URL_INTERVAL, tz=timezone.utc)
+    url = blob.generate_signed_url(expiration=expires_at)
+    # The shared entry ends with the current interval, so a URL read from Redis and then
+    # kept for another interval by st.cache_data still has at least 15 minutes left
+    set_shared_cache(cache_key, url, max(interval_start + SIGNED_URL_INTERVAL - now, 1))
     return url
 
+def generate_signed_urls(bucket_name, blob_names):
+    """
+    Generate signed URLs for several videos, returning {blob_name: url}
+    """
+    # Signing is local and cached, so threads would only add overhead
+    return {blob_name: generate_signed_url(bucket_name, blob_name) for blob_name in blob_names}
+
+class ProgressReader:
+    """
+    File wrapper that counts the bytes read from it, so upload progress can be shown
+    """
+    def __init__(self, file_obj):
+        self.file_obj = file_obj
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self.file_obj.read(size)
+        self.bytes_read += len(data)
+        return data
+
+    def seek(self, offset, whence=0):
+        position = self.file_obj.seek(offset, whence)
+        self.bytes_read = self.file_obj.tell()
+        return position
+
+    def __getattr__(self, name):
+        return getattr(self.file_obj, name)
+
+def faststart_remux(video_file):
+    """
+    Move the mp4 index (moov atom) to the front without re-encoding, so the video can be read before it is fully fetched.
+    Returns the remuxed video in memory, or None if ffmpeg is unavailable, fails or times out.
+    """
+    if shutil.which("ffmpeg") is None:
+        return None
+
+    # +faststart rewrites the file after muxing, so ffmpeg needs seekable files rather than pipes
+    with tempfile.TemporaryDirectory() as temp_dir:
+        source_path = os.path.join(temp_dir, "source.mp4")
+        output_path = os.path.join(temp_dir, "faststart.mp4")
+        with open(source_path, "wb") as source_file:
+            source_file.write(video_file.getvalue())
+
+        try:
+            result = subprocess.run(
+                ["ffmpeg", "-y", "-loglevel", "error", "-i", source_path,
+                 "-map", "0", "-c", "copy", "-movflags", "+faststart", output_path],
+                capture_output=True, timeout=FFMPEG_TIMEOUT
+            )
+        except subprocess.TimeoutExpired:
+            return None
+        if result.returncode != 0:
+            return None
+
+        with open(output_path, "rb") as output_file:
+            return io.BytesIO(output_file.read())
+
+def video_display_name(blob_name):
+    """
+    Return the file name of a stored video with a short form of its content hash, e.g. "clip.mp4 (1a2b3c4d)"
+    """
+    folder, _, file_name = blob_name.removeprefix(VIDEO_PREFIX).rpartition("/")
+    # Videos stored before content hashing sit directly under the prefix
+    return f"{file_name} ({folder[:8]})" if folder else file_name
+
 def upload_video_to_gcs(bucket_name, video_file):
     """
     Upload a video file to Google Cloud Storage
     """
-    bucket = storage_client.bucket(bucket_name)
+    bucket = get_storage_client().bucket(bucket_name)
     
     try:
-        # Create a new blob with a unique name to avoid overwriting
-        blob_name = f"{int(time.time())}_{video_file.name}" 
-        blob = bucket.blob(blob_name)
-        blob.upload_from_file(video_file)
+        # Name the blob after a hash of its content, so re-uploading the same video
+        # (under any file name) reuses the existing object instead of storing a copy
+        content_hash = hashlib.blake2b(video_file.getvalue(), digest_size=16).hexdigest()
+        content_prefix = f"{VIDEO_PREFIX}{content_hash}/"
+        existing_blobs = get_storage_client().list_blobs(bucket_name, prefix=content_prefix, max_results=1)
+        existing_blob = next(iter(existing_blobs), None)
+        if existing_blob is not None:
+            st.info(f"Video '{video_file.name}' is already stored as '{existing_blob.name}'.")
+            return existing_blob.name
+
+        blob_name = f"{content_prefix}{video_file.name}"
+        blob = bucket.blob(blob_name, chunk_size=UPLOAD_CHUNK_SIZE)
+        # Signed URLs for a given interval are identical, so browsers may reuse the video
+        blob.cache_control = "private, max-age=1800"
+
+        remuxed_file = faststart_remux(video_file)
+        upload_file = remuxed_file if remuxed_file is not None else video_file
+        upload_size = upload_file.seek(0, io.SEEK_END)
+        upload_file.seek(0)
+
+        # Upload in a worker thread so this thread can keep the progress bar moving
+        reader = ProgressReader(upload_file)
+        progress_text = f"Uploading '{video_file.name}'..."
+        progress = st.progress(0.0, text=progress_text)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            # if_generation_match=0 makes the upload fail rather than overwrite an existing object;
+            # the timeout is (connect, read) per chunk request, not for the whole file
+            upload = executor.submit(
+                blob.upload_from_file,
+                reader,
+                rewind=True,
+                content_type="video/mp4",
+                timeout=(30, 300),
+                checksum="crc32c",
+                if_generation_match=0
+            )
+            while not upload.done():
+                progress.progress(min(reader.bytes_read / max(upload_size, 1), 1.0), text=progress_text)
+                time.sleep(0.25)
+            progress.empty()
+            upload.result()
 
         st.success(f"Video '{video_file.name}' uploaded successfully as '{blob_name}'!")
         return blob_name
@@ -107,67 +375,449 @@ def upload_video_to_gcs(bucket_name, video_file):
         st.error(f"Error uploading file: {str(e)}")
         return None
 
-def analyze_video(video_uri, user_prompt, model_version):
+@st.cache_resource
+def get_model(model_version):
     """
-    Analyze video using Vertex AI and user prompt
+    Create one GenerativeModel per model version and reuse it across analyses
     """
-    video1 = Part.from_uri(mime_type="video/mp4", uri=video_uri)
-    
-    generation_config = {
-        "max_output_tokens": 8192,
-        "temperature": 0,
-        "top_p": 0.95,
+    return GenerativeModel(model_version)
+
+@st.cache_resource
+def get_analyzed_videos():
+    """
+    Process-wide lock and set of (video_uri, model_version) pairs that have been analyzed
+    """
+    return threading.Lock(), set()
+
+def mark_analyzed(video_uri, model_version):
+    """
+    Record that a video was analyzed with a model, returning whether it had been analyzed before
+    """
+    lock, analyzed_videos = get_analyzed_videos()
+    with lock:
+        seen_before = (video_uri, model_version) in analyzed_videos
+        analyzed_videos.add((video_uri, model_version))
+    return seen_before
+
+@st.cache_resource(ttl=CONTEXT_CACHE_TTL - timedelta(minutes=5), show_spinner=False)
+def get_cached_content(video_uri, model_version):
+    """
+    Create a Vertex AI context cache holding the video, so repeat analyses don't resend and reprocess it
+    """
+    try:
+        return caching.CachedContent.create(
+            model_name=model_version,
+            contents=[Part.from_uri(mime_type="video/mp4", uri=video_uri)],
+            ttl=CONTEXT_CACHE_TTL
+        )
+    except api_exceptions.GoogleAPICallError:
+        # Videos below the minimum cacheable token count (or any cache failure) fall back to sending the video
+        return None
+
+# Rate limits, unavailability and timeouts are retried up to 3 times with exponential backoff
+@retry(
+    stop=stop_after_attempt(3),
+    wait=wait_exponential(multiplier=1, min=2, max=30),
+    retry=retry_if_exception_type((
+        api_exceptions.ResourceExhausted,
+        api_exceptions.ServiceUnavailable,
+        api_exceptions.DeadlineExceeded
+    )),
+    reraise=True
+)
+def start_generation(model, contents):
+    """
+    Start a streaming generation and wait for its first chunk, so transient failures can be retried
+    """
+    responses = iter(model.generate_content(
+        contents,
+        generation_config=GENERATION_CONFIG,
+        safety_settings=SAFETY_SETTINGS,
+        stream=True
+    ))
+    # Request errors are raised on the first chunk; retrying later would repeat text already shown
+    first_response = next(responses, None)
+    if first_response is None:
+        return iter(())
+    return itertools.chain([first_response], responses)
+
+def analysis_cache_key(video_uri, user_prompt, model_version):
+    """
+    Build the analysis cache key from the video's checksum, so re-uploading a file under the same name invalidates it
+    """
+    bucket_name, _, blob_name = video_uri.removeprefix("gs://").partition("/")
+    # get_blob fetches the object metadata (one HEAD request); bucket.blob() would not
+    blob = get_storage_client().bucket(bucket_name).get_blob(blob_name)
+    video_checksum = blob.crc32c if blob is not None else video_uri
+    digest = hashlib.sha256(f"{model_version}|{video_checksum}|{user_prompt}".encode()).hexdigest()
+    return f"analysis:{digest}"
+
+@st.cache_resource
+def get_analysis_memory_cache():
+    """
+    Process-wide lock and {cache key: (expiry time, output)} of finished analyses, shared by all sessions
+    """
+    return threading.Lock(), {}
+
+def get_cached_analysis(cache_key):
+    """
+    Look up a finished analysis in this process first, then in the shared Redis cache
+    """
+    lock, memory_cache = get_analysis_memory_cache()
+    with lock:
+        entry = memory_cache.get(cache_key)
+    if entry is not None and entry[0] > time.time():
+        return entry[1]
+
+    output, ttl = get_shared_cache_with_ttl(cache_key)
+    if output is not None:
+        # Keep the local copy only as long as the shared entry lives
+        expires_at = time.time() + (ttl if ttl is not None else ANALYSIS_CACHE_TTL)
+        with lock:
+            memory_cache[cache_key] = (expires_at, output)
+    return output
+
+def set_cached_analysis(cache_key, output):
+    """
+    Store a finished analysis in this process and in the shared Redis cache
+    """
+    lock, memory_cache = get_analysis_memory_cache()
+    now = time.time()
+    with lock:
+        # Drop expired entries so the process cache doesn't grow without bound
+        for expired_key in [key for key, (expires_at, _) in memory_cache.items() if expires_at <= now]:
+            del memory_cache[expired_key]
+        memory_cache[cache_key] = (now + ANALYSIS_CACHE_TTL, output)
+    set_shared_cache(cache_key, output, ANALYSIS_CACHE_TTL)
+
+def prepare_analysis(video_uri, user_prompt, model_version, use_context_cache=True):
+    """
+    Resolve what an analysis needs from the app's caches; call it on the script thread.
+    Returns (cache_key, cached_output, model, contents), with model and contents None when the output is cached.
+    With use_context_cache, a video analyzed before in this process is served from a Vertex AI context cache.
+    """
+    cache_key = analysis_cache_key(video_uri, user_prompt, model_version)
+    cached_output = get_cached_analysis(cache_key)
+    if cached_output is not None:
+        return cache_key, cached_output, None, None
+
+    # Creating a context cache costs a full pass over the video plus storage, so only do it
+    # once the same video and model come back for another prompt
+    cached_content = None
+    if use_context_cache and mark_analyzed(video_uri, model_version):
+        cached_content = get_cached_content(video_uri, model_version)
+    if cached_content is not None:
+        # The video is already held in the context cache, so only the prompt is sent
+        model = PreviewGenerativeModel.from_cached_content(cached_content=cached_content)
+        contents = [user_prompt]
+    else:
+        video1 = Part.from_uri(mime_type="video/mp4", uri=video_uri)
+        model = get_model(model_version)
+        contents = [video1, user_prompt]
+    return cache_key, None, model, contents
+
+def generate_analysis(model, contents):
+    """
+    Yield the text of a streaming generation; it touches no Streamlit state, so it can run in a worker thread
+    """
+    for response in start_generation(model, contents):
+        yield response.text
+
+def analyze_video(video_uri, user_prompt, model_version, use_context_cache=True):
+    """
+    Analyze video using Vertex AI and user prompt, yielding text as it streams in
+    """
+    cache_key, cached_output, model, contents = prepare_analysis(
+        video_uri, user_prompt, model_version, use_context_cache
+    )
+    if cached_output is not None:
+        yield cached_output
+        return
+
+    # Keep the chunks so the full output can be cached once the stream completes
+    chunks = []
+    for chunk in generate_analysis(model, contents):
+        chunks.append(chunk)
+        yield chunk
+
+    set_cached_analysis(cache_key, "".join(chunks))
+
+def stream_in_background(streams):
+    """
+    Read each {name: stream} in its own thread, yielding (name, chunk) as chunks arrive.
+    The network reads keep going while the caller renders earlier chunks.
+    """
+    chunk_queue = queue.Queue()
+
+    def run(name, stream):
+        try:
+            for chunk in stream:
+                chunk_queue.put((name, chunk))
+        finally:
+            # None marks the end of this stream, even if it failed
+            chunk_queue.put((name, None))
+
+    executor = ThreadPoolExecutor(max_workers=len(streams))
+    try:
+        futures = [executor.submit(run, name, stream) for name, stream in streams.items()]
+        running = len(futures)
+        while running:
+            name, chunk = chunk_queue.get()
+            if chunk is None:
+                running -= 1
+            else:
+                yield name, chunk
+        for future in futures:
+            future.result()
+    finally:
+        # If the caller stops reading early (e.g. a rerun), don't block until the streams finish
+        executor.shutdown(wait=False)
+
+def compare_models(video_uri, user_prompt):
+    """
+    Analyze video with every model version in parallel, yielding (name, text) chunks as they stream in.
+    Cached handles are resolved on the script thread; the worker threads only stream from Vertex AI.
+    """
+    prepared = {
+        name: prepare_analysis(video_uri, user_prompt, model_version)
+        for name, model_version in MODEL_VERSIONS.items()
+    }
+    streams = {
+        name: iter([cached_output]) if cached_output is not None else generate_analysis(model, contents)
+        for name, (_, cached_output, model, contents) in prepared.items()
     }
 
-    safety_settings = [
-        SafetySetting(
-          category=SafetySetting.HarmCategory.HARM_CATEGORY_HATE_SPEECH,
-          threshold=SafetySetting.HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE
-        ),
-        SafetySetting(
-          category=SafetySetting.HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT,
-          threshold=SafetySetting.HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE
-        ),
-        SafetySetting(
-          category=SafetySetting.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT,
-          threshold=SafetySetting.HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE
-        ),
-        SafetySetting(
-          category=SafetySetting.HarmCategory.HARM_CATEGORY_HARASSMENT,
-          threshold=SafetySetting.HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE
-        ),
+    outputs = {name: [] for name in streams}
+    for name, chunk in stream_in_background(streams):
+        outputs[name].append(chunk)
+        yield name, chunk
+
+    # Every stream has completed, so cache the new outputs from the script thread
+    for name, (cache_key, cached_output, _, _) in prepared.items():
+        if cached_output is None:
+            set_cached_analysis(cache_key, "".join(outputs[name]))
+
+def analyze_videos(video_uris, user_prompt, model_version):
+    """
+    Analyze several videos in parallel, yielding (video_uri, output) as each one finishes.
+    Cached handles are resolved on the script thread; the worker threads only call Vertex AI.
+    """
+    def run(model, contents):
+        return "".join(generate_analysis(model, contents))
+
+    executor = ThreadPoolExecutor(max_workers=min(8, len(video_uris)))
+    try:
+        futures = {}
+        ready_outputs = []
+        for video_uri in video_uris:
+            try:
+                # Each video is analyzed once here, so a context cache would never be reused
+                cache_key, cached_output, model, contents = prepare_analysis(
+                    video_uri, user_prompt, model_version, use_context_cache=False
+                )
+            except Exception as e:
+                ready_outputs.append((video_uri, f"Error analyzing video: {str(e)}"))
+                continue
+            if cached_output is not None:
+                ready_outputs.append((video_uri, cached_output))
+            else:
+                futures[executor.submit(run, model, contents)] = (video_uri, cache_key)
+
+        yield from ready_outputs
+        for future in as_completed(futures):
+            video_uri, cache_key = futures[future]
+            try:
+                output = future.result()
+            except Exception as e:
+                # One failed video shouldn't hide the results of the others
+                output = f"Error analyzing video: {str(e)}"
+            else:
+                set_cached_analysis(cache_key, output)
+            yield video_uri, output
+    finally:
+        # If the caller stops reading early (e.g. a rerun), don't block until every video finishes
+        executor.shutdown(wait=False)
+
+def submit_batch_job(bucket_name, video_uris, user_prompt, model_version):
+    """
+    Submit a Vertex AI batch prediction job analyzing several videos, returning the job's resource name
+    """
+    batch_requests = [
+        {
+            "request": {
+                "contents": [{
+                    "role": "user",
+                    "parts": [
+                        {"fileData": {"mimeType": "video/mp4", "fileUri": video_uri}},
+                        {"text": user_prompt}
+                    ]
+                }],
+                "generationConfig": GENERATION_CONFIG,
+                "safetySettings": [setting.to_dict() for setting in SAFETY_SETTINGS]
+            }
+        }
+        for video_uri in video_uris
     ]
-    
-    model = GenerativeModel(model_version)
-    
-    responses = model.generate_content(
-        [video1, user_prompt],
-        generation_config=generation_config,
-        safety_settings=safety_settings,
-        stream=True
+
+    # Stage the requests as JSONL next to the videos, under a per-job prefix
+    job_id = uuid.uuid4().hex
+    bucket = get_storage_client().bucket(bucket_name)
+    input_blob = bucket.blob(f"batch-jobs/{job_id}.jsonl")
+    input_blob.upload_from_string(
+        "\n".join(json.dumps(request) for request in batch_requests),
+        content_type="application/jsonl"
     )
 
-    output = ""
-    for response in responses:
-        output += response.text
+    job = BatchPredictionJob.submit(
+        source_model=model_version,
+        input_dataset=f"gs://{bucket_name}/{input_blob.name}",
+        output_uri_prefix=f"gs://{bucket_name}/batch-jobs/{job_id}/"
+    )
+    return job.resource_name
 
-    return output
+def wait_for_batch_job(bucket_name, resource_name):
+    """
+    Poll a batch prediction job until it ends, returning {video_uri: output}
+    """
+    job = BatchPredictionJob(resource_name)
+    progress = st.progress(0.0, text="Checking batch job...")
+    while not job.has_ended:
+        state = job.state.name
+        progress.progress(BATCH_JOB_PROGRESS.get(state, 0.0), text=f"Batch job {state}...")
+        time.sleep(BATCH_POLL_INTERVAL)
+        job.refresh()
+    progress.empty()
+
+    if not job.has_succeeded:
+        st.error(f"Batch job failed: {job.error}")
+        return {}
+
+    # Predictions are written as JSONL files under the job's output location
+    output_prefix = job.output_location.removeprefix(f"gs://{bucket_name}/")
+    results = {}
+    for blob in get_storage_client().list_blobs(bucket_name, prefix=output_prefix):
+        if not blob.name.endswith(".jsonl"):
+            continue
+        for line in blob.download_as_text().splitlines():
+            record = json.loads(line)
+            video_uri = record["request"]["contents"][0]["parts"][0]["fileData"]["fileUri"]
+            candidates = record.get("response", {}).get("candidates", [])
+            if candidates:
+                results[video_uri] = "".join(part.get("text", "") for part in candidates[0]["content"]["parts"])
+            else:
+                results[video_uri] = f"No output: {record.get('status', 'unknown error')}"
+    return results
+
+def show_video_results(bucket_name, videos, results, source):
+    """
+    Show each (video_uri, output) result in its own expander, with a preview of the video.
+    Widget keys are prefixed with source, so results from different runs can appear in the same pass.
+    """
+    video_urls = generate_signed_urls(bucket_name, videos)
+    for video_uri, analysis_result in results:
+        video = video_uri.removeprefix(f"gs://{bucket_name}/")
+        with st.expander(video_display_name(video)):
+            st.video(video_urls[video])
+            st.text_area("Analysis Output", analysis_result, height=300, key=f"{source}:{video_uri}")
+
+# Runs as a fragment so changing the model or prompt, or clicking Run Analysis,
+# reruns only this section instead of the whole page
+@st.fragment
+def analysis_fragment(bucket_name, selected_videos, batch_mode):
+    """
+    Model and prompt inputs plus the analysis output for the selected videos
+    """
+    # Step 2: Model and Prompt
+    st.header("Step 2: Choose Model Version and Enter Prompt", anchor=False)
+    
+    col1, col2 = st.columns(2)
+
+    with col1:
+        model_version = st.selectbox("Select Model Version", list(MODEL_VERSIONS))
+        selected_model_version = MODEL_VERSIONS[model_version]
+        compare_enabled = st.checkbox("Compare both models", disabled=batch_mode)
+        use_batch_job = st.checkbox(
+            "Run as a Vertex AI batch prediction job",
+            value=True,
+            disabled=not batch_mode,
+            help="Batch jobs are billed at a lower rate but are queued, so results can take a long time. "
+                 "Otherwise the videos are analyzed in parallel right away."
+        )
+
+    with col2:
+        user_prompt = st.text_area("Enter your analysis prompt", 
+                                    value="Give time steps of any aircraft tries an attempt to refuel, do not leave out any attempts due to any reason? During this time layout time for each attempt whether successful or unsuccessful.")
+
+    # "Run Analysis" button with customized light blue color and larger, bold text
+    run_analysis = st.button("Run Analysis")
+
+    if run_analysis and not selected_videos:
+        st.warning("Select a video to analyze.")
+    elif run_analysis and batch_mode and use_batch_job:
+        video_uris = [f"gs://{bucket_name}/{video}" for video in selected_videos]
+        # Remember the job so polling picks up again if a widget interaction interrupts it
+        st.session_state.batch_job = {
+            "resource_name": submit_batch_job(bucket_name, video_uris, user_prompt, selected_model_version),
+            "videos": selected_videos
+        }
+    elif run_analysis and batch_mode:
+        video_uris = [f"gs://{bucket_name}/{video}" for video in selected_videos]
+        with st.spinner("Analyzing videos..."):
+            # Videos are analyzed concurrently and each result is shown as soon as it finishes
+            show_video_results(
+                bucket_name, selected_videos, analyze_videos(video_uris, user_prompt, selected_model_version),
+                "parallel"
+            )
+        st.success("Batch analysis complete!")
+    elif run_analysis:
+        with st.spinner("Analyzing video..."):
+            video_uri = f"gs://{bucket_name}/{selected_videos[0]}"
+            st.header("Analysis Output", anchor=False)
+            if compare_enabled:
+                # Both models run concurrently and each column shows its tokens as they arrive
+                output_placeholders = {}
+                for name, column in zip(MODEL_VERSIONS, st.columns(len(MODEL_VERSIONS))):
+                    column.markdown(f"**{name}**")
+                    output_placeholders[name] = column.container(height=300).empty()
+                outputs = {name: [] for name in MODEL_VERSIONS}
+                for name, chunk in compare_models(video_uri, user_prompt):
+                    outputs[name].append(chunk)
+                    output_placeholders[name].markdown("".join(outputs[name]))
+                st.success("Analysis complete!")
+            else:
+                # Render tokens as they arrive instead of waiting for the full response
+                with st.container(height=300):
+                    analysis_result = st.write_stream(analyze_video(video_uri, user_prompt, selected_model_version))
+                if analysis_result:
+                    st.success("Analysis complete!")
+
+    # A submitted batch job is polled on every run of this section until it ends
+    batch_job = st.session_state.get("batch_job")
+    if batch_job is not None:
+        batch_results = wait_for_batch_job(bucket_name, batch_job["resource_name"])
+        del st.session_state.batch_job
+        # A failed batch job has already reported its error
+        if batch_results:
+            show_video_results(bucket_name, batch_job["videos"], [
+                (f"gs://{bucket_name}/{video}", batch_results.get(f"gs://{bucket_name}/{video}", "No output"))
+                for video in batch_job["videos"]
+            ], "batch_job")
+            st.success("Batch analysis complete!")
 
 def main():
     # Load background image and encode it to base64
-    with open("p52.jpg", "rb") as image_file:
-        encoded_image = base64.b64encode(image_file.read()).decode()
+    encoded_image = load_background_image("p52.jpg", os.path.getmtime("p52.jpg"))
 
     # Set the background using the encoded image and set text/button colors
     set_bg_hack(encoded_image)
 
-    st.markdown("<h1 style='text-align: center;'>Visual Question Answering System</h1>", unsafe_allow_html=True)
+    st.title("Visual Question Answering System", anchor=False)
     st.markdown("<p style='text-align: center;'>Use AI to analyze aerial refueling videos and extract meaningful insights.</p>", unsafe_allow_html=True)
 
-    bucket_name = "air-refueling-video-analysis-bucket"  # Make sure this is the correct bucket name
+    bucket_name = BUCKET_NAME
 
     # Step 1: Upload or Select a Video
-    st.markdown("<h2>Step 1: Upload or Select a Video</h2>", unsafe_allow_html=True)
+    st.header("Step 1: Upload or Select a Video", anchor=False)
 
     # Initialize session state to keep track of uploaded videos
     if 'uploaded_video_list' not in st.session_state:
@@ -176,57 +826,55 @@ def main():
     # Upload and Video Preview - Video preview under upload button
     uploaded_video = st.file_uploader("Upload a .mp4 video", type=["mp4"])
 
-    # Automatically upload the video when it is selected
-    if uploaded_video is not None:
+    # Automatically upload the video when it is selected, once per file rather than on every rerun
+    if uploaded_video is not None and uploaded_video.file_id != st.session_state.get("uploaded_file_id"):
         with st.spinner("Uploading video..."):
             uploaded_blob_name = upload_video_to_gcs(bucket_name, uploaded_video)
             if uploaded_blob_name:
-                # Update the session state video list without refreshing the app
-                st.session_state.uploaded_video_list = list_videos(bucket_name)
-                st.success(f"Video '{uploaded_blob_name}' uploaded successfully!")
+                st.session_state.uploaded_file_id = uploaded_video.file_id
+                # Add the new video to the session state list instead of listing the bucket again;
+                # clearing the listing cache lets other sessions pick it up on their next listing
+                list_videos.clear()
+                if uploaded_blob_name not in st.session_state.uploaded_video_list:
+                    st.session_state.uploaded_video_list.append(uploaded_blob_name)
+                    st.session_state.uploaded_video_list.sort()
+                # Select the new upload; Vertex AI reads it straight from GCS by its gs:// URI
+                # upload_video_to_gcs has already reported whether it uploaded or reused a copy
+                st.session_state.selected_video = uploaded_blob_name
 
-    # Select a video from the session state list
-    selected_video = st.selectbox("Select a video to analyze", st.session_state.uploaded_video_list)
+    # Batch mode submits several videos as one Vertex AI batch prediction job
+    batch_mode = st.toggle("Batch mode")
 
-    # Display the selected video underneath the upload option
-    if selected_video:
-        video_url = generate_signed_url(bucket_name, selected_video)
-        st.video(video_url)
+    if batch_mode:
+        selected_videos = st.multiselect(
+            "Select videos to analyze", st.session_state.uploaded_video_list, format_func=video_display_name
+        )
+    else:
+        # Select a video from the session state list
+        selected_video = st.selectbox(
+            "Select a video to analyze", st.session_state.uploaded_video_list, key="selected_video",
+            format_func=video_display_name
+        )
 
-    # Step 2: Model and Prompt
-    st.markdown("<h2>Step 2: Choose Model Version and Enter Prompt</h2>", unsafe_allow_html=True)
-    
-    col1, col2 = st.columns(2)
+        selected_videos = [selected_video] if selected_video else []
 
-    with col1:
-        model_version = st.selectbox("Select Model Version", ["Light", "Pro"])
-        model_version_mapping = {
-            "Light": "gemini-1.5-flash-001",
-            "Pro": "gemini-1.5-pro-001"
-        }
-        selected_model_version = model_version_mapping[model_version]
-
-    with col2:
-        user_prompt = st.text_area("Enter your analysis prompt", 
-                                    value="Give time steps of any aircraft tries an attempt to refuel, do not leave out any attempts due to any reason? During this time layout time for each attempt whether successful or unsuccessful.")
+        # Display the selected video underneath the upload option
+        if selected_video:
+            video_url = generate_signed_url(bucket_name, selected_video)
+            st.video(video_url)
 
-    # "Run Analysis" button with customized light blue color and larger, bold text
-    if st.button("Run Analysis"):
-        with st.spinner("Analyzing video..."):
-            video_uri = f"gs://{bucket_name}/{selected_video}"
-            analysis_result = analyze_video(video_uri, user_prompt, selected_model_version)
-            if analysis_result:
-                st.success("Analysis complete!")
-                st.text_area("Analysis Output", analysis_result, height=300)
+    analysis_fragment(bucket_name, selected_videos, batch_mode)
 
     # Expander for "How to use this app"
     with st.expander("How to use this app", expanded=False):
         st.markdown("""
         ### Step-by-Step Guide:
         1. **Select a Video**: Choose from existing videos or upload a new one.
-        2. **Select a Model Version**: Choose between the light or pro version depending on your needs.
+        2. **Select a Model Version**: Choose between the light or pro version depending on your needs, or tick "Compare both models" to run them side by side.
         3. **Enter an Analysis Prompt**: Provide a custom prompt for the AI to analyze.
         4. **Run Analysis**: Click the button to run the analysis and review the output.
+
+        Turn on **Batch mode** to analyze several videos at once, either in parallel or as a Vertex AI batch prediction job.
         """)
 
 if __name__ == "__main__":